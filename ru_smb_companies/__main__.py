@@ -1,4 +1,6 @@
 from .main import app
 
 
-app(prog_name="ru-smb-companies")
+# Guard keeps worker processes started with spawn from running the app again
+if __name__ == "__main__":
+    app(prog_name="ru-smb-companies")
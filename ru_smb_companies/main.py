@@ -1,24 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
 import enum
+import functools
 import json
+import multiprocessing
 import pathlib
+import sys
 from typing import List, Optional
 from typing_extensions import Annotated
 
 import typer
 
-from ru_smb_companies.stages.aggregate import Aggregator
+
+# Spark-based stages (aggregate, geocode, panelize) are imported inside
+# respective commands, so that other commands do not pay for PySpark import
 from ru_smb_companies.stages.download import Downloader
 from ru_smb_companies.stages.extract import Extractor
-from ru_smb_companies.stages.geocode import Geocoder
-from ru_smb_companies.stages.panelize import Panelizer
-from ru_smb_companies.utils.enums import SourceDatasets, StageNames, Storages
+from ru_smb_companies.utils.enums import Engines, SourceDatasets, StageNames, Storages
+from ru_smb_companies.utils.stage_cache import stage_cache
 
 
 APP_NAME = "ru_smb_companies"
 
+# Shell completion is disabled: its setup detects the current shell
+# on every run, which slows down startup of a batch tool
 app = typer.Typer(
     help="Create dataset of Russian SMB companies (and individuals) based on Federal Tax Service's open data",
-    rich_markup_mode="markdown"
+    rich_markup_mode="markdown",
+    add_completion=False
 )
 download_app = typer.Typer()
 extract_app = typer.Typer()
@@ -45,39 +53,57 @@ app.add_typer(
     no_args_is_help=True
 )
 
-default_config = dict(storage="local", token="", num_workers=1, chunksize=16)
+
+@app.callback()
+def set_up_multiprocessing():
+    # Extractor workers are forked to inherit already imported modules instead
+    # of importing them again; Python 3.14+ no longer forks by default on Linux.
+    # Other platforms keep their default, as fork is unsafe on macOS.
+    # Worker pools are started before any threads, so forking is safe
+    if sys.platform.startswith("linux"):
+        multiprocessing.set_start_method("fork", force=True)
+
+
+default_config = dict(storage="local", token="", num_workers=1, chunksize=16, concurrency=16, engine="spark")
 
 app_dir = typer.get_app_dir(APP_NAME)
 app_config_path = pathlib.Path(app_dir) / "config.json"
-app_config_path.parent.mkdir(parents=True, exist_ok=True)
-try:
-    with open(app_config_path) as f:
-        app_config = json.load(f)
-except:
-    app_config = {}
-    print("Failed to load config, default options are loaded")
-    app_config = default_config
 
 
+@functools.lru_cache(maxsize=1)
+def get_app_config() -> dict:
+    """Load config on first use rather than on import"""
+    try:
+        with open(app_config_path) as f:
+            app_config = json.load(f)
+    except:
+        print("Failed to load config, default options are loaded")
+        app_config = dict(default_config)
+
+    return app_config
+
+
+@functools.lru_cache(maxsize=None)
 def get_default_path(
     stage_name: str,
     source_dataset: Optional[str] = None,
     filename: Optional[str] = None,
 ) -> pathlib.Path:
-    path = pathlib.Path("ru-smb-data") / stage_name
-    if source_dataset is not None:
-        path = path / source_dataset
-    if filename is not None:
-        path = path / filename
+    parts = [p for p in (source_dataset, filename) if p is not None]
 
-    return path
+    return pathlib.Path("ru-smb-data", stage_name, *parts)
+
+
+def get_engine() -> str:
+    return get_app_config().get("engine", default_config["engine"])
 
 
 def get_downloader(app_config: dict) -> Downloader:
     storage = app_config.get("storage")
     token = app_config.get("token")
+    concurrency = app_config.get("concurrency", default_config["concurrency"])
 
-    return Downloader(storage, token)
+    return Downloader(storage, token, concurrency)
 
 
 def get_extractor(app_config: dict) -> Extractor:
@@ -101,13 +127,15 @@ def download_all(
     """
     Download all three source dataset(s)
     """
-    d = get_downloader(app_config)
-    for source_dataset in SourceDatasets:
-        args = dict(
-            download_dir=str(download_dir / source_dataset.value),
-            source_dataset = source_dataset.value
-        )
-        d(**args)
+    app_config = get_app_config()
+
+    def download(source_dataset: SourceDatasets):
+        d = get_downloader(app_config)
+        d(source_dataset.value, str(download_dir / source_dataset.value))
+
+    # Datasets are independent, so they are downloaded concurrently
+    with ThreadPoolExecutor(max_workers=len(SourceDatasets)) as executor:
+        list(executor.map(download, SourceDatasets))
 
 
 @download_app.command("smb", rich_help_panel="Source dataset(s)")
@@ -122,7 +150,7 @@ def download_smb(
     """
     Download **s**mall&**m**edium-sized **b**usinesses registry
     """
-    d = get_downloader(app_config)
+    d = get_downloader(get_app_config())
     d(SourceDatasets.smb.value, str(download_dir))
 
 
@@ -138,7 +166,7 @@ def download_revexp(
     """
     Download data on **rev**enue and **exp**enditure of companies
     """
-    d = get_downloader(app_config)
+    d = get_downloader(get_app_config())
     d(SourceDatasets.revexp.value, str(download_dir))
 
 
@@ -154,7 +182,7 @@ def download_empl(
     """
     Download data on number of **empl**oyees in companies
     """
-    d = get_downloader(app_config)
+    d = get_downloader(get_app_config())
     d(SourceDatasets.empl.value, str(download_dir))
 
 
@@ -169,7 +197,7 @@ def extract_all(
     out_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to save extracted CSV files. Sub-folders *smb*, *revexp*, *empl* for respective datasets will be created automatically"
+            help="Path to save extracted Parquet files. Sub-folders *smb*, *revexp*, *empl* for respective datasets will be created automatically"
         )
     ] = get_default_path(StageNames.extract.value),
     clear: Annotated[
@@ -186,16 +214,22 @@ def extract_all(
     """
     Extract data from all three downloaded source datasets
     """
-    e = get_extractor(app_config)
-    for source_dataset in SourceDatasets:
-        args = dict(
+    def extract(source_dataset: SourceDatasets):
+        e(
             in_dir=str(in_dir / source_dataset.value),
             out_dir=str(out_dir / source_dataset.value),
             source_dataset=source_dataset.value,
             clear=clear,
             activity_codes=ac,
         )
-        e(**args)
+
+    # A single pool of workers is started before any threads and shared
+    # by all datasets, so the configured number of workers is respected
+    with get_extractor(get_app_config()) as e:
+        # Clearing asks for confirmation interactively, so prompts must not overlap
+        max_workers = 1 if clear else len(SourceDatasets)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(extract, SourceDatasets))
 
 
 @extract_app.command("smb", rich_help_panel="Source dataset(s)")
@@ -209,7 +243,7 @@ def extract_smb(
     out_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to save extracted CSV files"
+            help="Path to save extracted Parquet files"
         )
     ] = get_default_path(StageNames.extract.value, SourceDatasets.smb.value),
     clear: Annotated[
@@ -224,10 +258,10 @@ def extract_smb(
     ] = None,
 ):
     """
-    Extract data from downloaded *zip* archives of SMB registry to *csv* files,
+    Extract data from downloaded *zip* archives of SMB registry to *parquet* files,
     optionally filtering by activity code (stage 2)
     """
-    e = get_extractor(app_config)
+    e = get_extractor(get_app_config())
     e(str(in_dir), str(out_dir), SourceDatasets.smb.value, clear, ac)
 
 
@@ -242,7 +276,7 @@ def extract_revexp(
     out_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to save extracted CSV files"
+            help="Path to save extracted Parquet files"
         )
     ] = get_default_path(StageNames.extract.value, SourceDatasets.revexp.value),
     clear: Annotated[
@@ -250,9 +284,9 @@ def extract_revexp(
     ] = False
 ):
     """
-    Extract data from downloaded *zip* archives of revexp data to *csv* files
+    Extract data from downloaded *zip* archives of revexp data to *parquet* files
     """
-    e = get_extractor(app_config)
+    e = get_extractor(get_app_config())
     e(str(in_dir), str(out_dir), SourceDatasets.revexp.value, clear)
 
 
@@ -267,7 +301,7 @@ def extract_empl(
     out_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to save extracted CSV files"
+            help="Path to save extracted Parquet files"
         )
     ] = get_default_path(StageNames.extract.value, SourceDatasets.empl.value),
     clear: Annotated[
@@ -275,9 +309,9 @@ def extract_empl(
     ] = False
 ):
     """
-    Extract data from downloaded *zip* archives of empl data to *csv* files
+    Extract data from downloaded *zip* archives of empl data to *parquet* files
     """
-    e = get_extractor(app_config)
+    e = get_extractor(get_app_config())
     e(str(in_dir), str(out_dir), SourceDatasets.empl.value, clear)
 
 
@@ -286,7 +320,7 @@ def aggregate_all(
     in_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to extracted CSV files. Usually the same as *out_dir* on extract stage. Expected to contain *smb*, *revexp*, *empl* sub-folders"
+            help="Path to extracted Parquet files. Usually the same as *out_dir* on extract stage. Expected to contain *smb*, *revexp*, *empl* sub-folders"
         )
     ] = get_default_path(StageNames.extract.value),
     out_dir: Annotated[
@@ -299,8 +333,11 @@ def aggregate_all(
     """
     Aggregate all three source datasets
     """
+    from ru_smb_companies.stages.aggregate import Aggregator
+
     a = Aggregator()
-    for source_dataset in SourceDatasets:
+
+    def aggregate(source_dataset: SourceDatasets):
         args = dict(
             in_dir=str(in_dir / source_dataset.value),
             out_file=str(out_dir / source_dataset.value / "agg.csv"),
@@ -310,13 +347,20 @@ def aggregate_all(
             args["smb_data_file"] = str(get_default_path(StageNames.aggregate.value, SourceDatasets.smb.value, "agg.csv"))
         a(**args)
 
+    # revexp and empl are filtered by aggregated smb data, so smb goes first
+    # and the other two run concurrently on the same Spark session
+    with ThreadPoolExecutor(max_workers=len(SourceDatasets)) as executor:
+        executor.submit(aggregate, SourceDatasets.smb).result()
+        list(executor.map(aggregate, [SourceDatasets.revexp, SourceDatasets.empl]))
+
 
 @aggregate_app.command("smb", rich_help_panel="Source dataset(s)")
+@stage_cache(inputs=["in_dir"], output="out_file")
 def aggregate_smb(
     in_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to extracted CSV files. Usually the same as *out_dir* on extract stage"
+            help="Path to extracted Parquet files. Usually the same as *out_dir* on extract stage"
         )
     ] = get_default_path(StageNames.extract.value, SourceDatasets.smb.value),
     out_file: Annotated[
@@ -329,16 +373,19 @@ def aggregate_smb(
     """
     Aggregate SMB dataset
     """
+    from ru_smb_companies.stages.aggregate import Aggregator
+
     a = Aggregator()
     a(str(in_dir), str(out_file), SourceDatasets.smb.value)
 
 
 @aggregate_app.command("revexp", rich_help_panel="Source dataset(s)")
+@stage_cache(inputs=["in_dir", "smb_data_file"], output="out_file")
 def aggregate_revexp(
     in_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to extracted CSV files. Usually the same as *out_dir* on extract stage"
+            help="Path to extracted Parquet files. Usually the same as *out_dir* on extract stage"
         )
     ] = get_default_path(StageNames.extract.value, SourceDatasets.revexp.value),
     out_file: Annotated[
@@ -360,16 +407,19 @@ def aggregate_revexp(
     """
     Aggregate revexp dataset
     """
+    from ru_smb_companies.stages.aggregate import Aggregator
+
     a = Aggregator()
     a(str(in_dir), str(out_file), SourceDatasets.revexp.value, str(smb_data_file))
 
 
 @aggregate_app.command("empl", rich_help_panel="Source dataset(s)")
+@stage_cache(inputs=["in_dir", "smb_data_file"], output="out_file")
 def aggregate_empl(
     in_dir: Annotated[
         Optional[pathlib.Path],
         typer.Option(
-            help="Path to extracted CSV files. Usually the same as *out_dir* on extract stage"
+            help="Path to extracted Parquet files. Usually the same as *out_dir* on extract stage"
         )
     ] = get_default_path(StageNames.extract.value, SourceDatasets.empl.value),
     out_file: Annotated[
@@ -391,11 +441,14 @@ def aggregate_empl(
     """
     Aggregate empl dataset
     """
+    from ru_smb_companies.stages.aggregate import Aggregator
+
     a = Aggregator()
     a(str(in_dir), str(out_file), SourceDatasets.empl.value, str(smb_data_file))
 
 
 @app.command(rich_help_panel="Stages")
+@stage_cache(inputs=["in_file"], output="out_file")
 def geocode(
     in_file: Annotated[
         Optional[pathlib.Path],
@@ -416,11 +469,18 @@ def geocode(
     """
     Geocode SMB aggregated data (stage 4)
     """
+    from ru_smb_companies.stages.geocode import Geocoder
+
     g = Geocoder()
     g(str(in_file), str(out_file))
 
 
 @app.command(rich_help_panel="Stages")
+@stage_cache(
+    inputs=["smb_file", "revexp_file", "empl_file"],
+    output="out_file",
+    settings=lambda: {"engine": get_engine()}
+)
 def panelize(
     smb_file: Annotated[
         Optional[pathlib.Path],
@@ -459,6 +519,11 @@ def panelize(
     """
     Make panel dataset based on geocoded SMB data and aggregated revexp and empl tables (stage 5)
     """
+    if get_engine() == Engines.polars.value:
+        from ru_smb_companies.stages.panelize_polars import PolarsPanelizer as Panelizer
+    else:
+        from ru_smb_companies.stages.panelize import Panelizer
+
     p = Panelizer()
     p(str(smb_file), str(out_file), str(revexp_file), str(empl_file))
 
@@ -481,10 +546,18 @@ def config(
         int,
         typer.Option(help="Number of workers = processes for extractor", rich_help_panel="Available options")
     ] = 1,
+    concurrency: Annotated[
+        int,
+        typer.Option(help="Max number of files downloaded simultaneously by downloader", rich_help_panel="Available options")
+    ] = 16,
     storage: Annotated[
         Storages,
         typer.Option(help="Place to download source datasets (note: *source datasets only* rather than all other files)", rich_help_panel="Available options")
     ] = Storages.local.value,
+    engine: Annotated[
+        Engines,
+        typer.Option(help="Data processing engine for panelize stage; *polars* is faster on a single machine", rich_help_panel="Available options")
+    ] = Engines.spark.value,
     ydisk_token: Annotated[
         str,
         typer.Option(help="Token for Yandex Disk; used if *storage* is *ydisk*", rich_help_panel="Available options")
@@ -493,6 +566,8 @@ def config(
     """
     Show or set global options for all commands
     """
+    app_config = get_app_config()
+
     if show:
         print("Current configuration")
         for key, value in app_config.items():
@@ -503,8 +578,11 @@ def config(
     app_config["token"] = ydisk_token
     app_config["num_workers"] = num_workers
     app_config["chunksize"] = chunksize
+    app_config["concurrency"] = concurrency
     app_config["storage"] = storage.value
+    app_config["engine"] = engine.value
 
+    app_config_path.parent.mkdir(parents=True, exist_ok=True)
     with open(app_config_path, "w") as f:
         json.dump(app_config, f)
 
@@ -534,6 +612,17 @@ def process(
         download_all()
 
     extract_all(ac=ac)
-    aggregate_all()
-    geocode()
+    aggregate_smb()
+
+    # Geocoding needs only smb data, so it runs along with aggregation
+    # of revexp and empl datasets; panel requires all three results
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(aggregate_revexp),
+            executor.submit(aggregate_empl),
+            executor.submit(geocode),
+        ]
+        for future in futures:
+            future.result()
+
     panelize()
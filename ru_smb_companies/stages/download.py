@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import pathlib
 import time
 from typing import Dict, List, Optional
@@ -16,6 +17,8 @@ class Downloader:
         "upload": "disk/resources/upload",
     }
     HOST = "https://cloud-api.yandex.net/v1/"
+    LARGE_FILE_SIZE = 100 * 2**20 # 100 Mib
+    LARGE_FILES_CONCURRENCY = 4
     OPENDATA_URLS = {
         SourceDatasets.smb.value: "https://www.nalog.gov.ru/opendata/7707329152-rsmp/",
         SourceDatasets.revexp.value: "https://www.nalog.gov.ru/opendata/7707329152-revexp/",
@@ -25,7 +28,7 @@ class Downloader:
     YDISK_DOWNLOAD_TIMEOUT = 60
 
     def __init__(self, storage: str = Storages.local.value,
-                 token: Optional[str] = None):
+                 token: Optional[str] = None, concurrency: int = 16):
         if storage not in self.STORAGES:
             raise RuntimeError(
                 f"Unknown storage {storage}, expected one of {self.STORAGES}")
@@ -35,6 +38,7 @@ class Downloader:
 
         self._token = token
         self._storage = storage
+        self._concurrency = max(1, concurrency)
 
     def __call__(self, source_dataset: str, download_dir: Optional[str] = None):
         if source_dataset not in self.OPENDATA_URLS:
@@ -199,16 +203,29 @@ class Downloader:
 
         return False
 
+    def _get_remote_file_size(self, file_url: str) -> int:
+        try:
+            resp = requests.head(file_url, allow_redirects=True, timeout=10)
+        except Exception:
+            return 0
+
+        if resp.status_code != 200:
+            return 0
+
+        size = resp.headers.get("Content-Length", "")
+
+        return int(size) if size.isdigit() else 0
+
     def _save_remote_file_to_local(self, file_url: str, download_dir: str):
         filename = self._extract_filename_from_url(file_url)
         download_path = pathlib.Path(download_dir) / filename
         resp = requests.get(file_url, stream=True)
         if resp.status_code != 200:
-            print("Cannot download file")
+            print(f"Cannot download file {filename}")
             return
 
         with open(download_path, "wb") as f:
-            for chunk in tqdm.tqdm(resp.iter_content(2**20)): # chunk size is 1 Mib
+            for chunk in tqdm.tqdm(resp.iter_content(2**20), desc=filename): # chunk size is 1 Mib
                 f.write(chunk)
 
     def _save_remote_file_to_ydisk(self, file_url: str, path: str) -> Optional[str]:
@@ -280,10 +297,36 @@ class Downloader:
 
     def _download_to_local(self, data_urls: List[str], download_dir: str):
         existing_files = self._get_existing_files_local(download_dir)
-        for url in data_urls:
-            if self._check_existing(url, existing_files):
-                continue
-            self._save_remote_file_to_local(url, download_dir)
+        urls = [url for url in data_urls
+                if not self._check_existing(url, existing_files)]
+        if len(urls) == 0:
+            return
+
+        # Large files go to a separate smaller pool,
+        # so that they do not compete for bandwidth with many small ones
+        with ThreadPoolExecutor(max_workers=self._concurrency) as pool:
+            sizes = list(pool.map(self._get_remote_file_size, urls))
+        small_urls = [url for url, size in zip(urls, sizes)
+                      if size <= self.LARGE_FILE_SIZE]
+        large_urls = [url for url, size in zip(urls, sizes)
+                      if size > self.LARGE_FILE_SIZE]
+
+        print(f"Downloading {len(small_urls)} small and {len(large_urls)} large file(s)")
+
+        large_files_concurrency = min(self._concurrency, self.LARGE_FILES_CONCURRENCY)
+        with (
+            ThreadPoolExecutor(max_workers=self._concurrency) as small_pool,
+            ThreadPoolExecutor(max_workers=large_files_concurrency) as large_pool
+        ):
+            futures = [
+                small_pool.submit(self._save_remote_file_to_local, url, download_dir)
+                for url in small_urls
+            ] + [
+                large_pool.submit(self._save_remote_file_to_local, url, download_dir)
+                for url in large_urls
+            ]
+            for future in futures:
+                future.result()
 
     def _extract_filename_from_url(self, url: str) -> str:
         *_, filename = url.rpartition("/")
@@ -7,13 +7,15 @@ import string
 import sys
 import tempfile
 import time
-from typing import List, Optional
+from typing import FrozenSet, List, Optional
 from urllib.parse import urljoin
 import zipfile
 
 from lxml import etree
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 from tqdm import tqdm
 
@@ -22,6 +24,12 @@ from ..utils.elements import elements
 from ..utils.enums import SourceDatasets, Storages
 
 
+@functools.lru_cache(maxsize=None)
+def _get_xpath(path: str) -> etree.XPath:
+    """Compile XPath expression once per worker process rather than per document"""
+    return etree.XPath(path)
+
+
 def _make_dataframe(item, elements, target_codes=None, debug=True):
     if len(item) != 2:
         print("make_dataframe function expects filename and its content as a [str, str] tuple")
@@ -33,15 +41,18 @@ def _make_dataframe(item, elements, target_codes=None, debug=True):
         root = etree.fromstring(xml_string, parser=parser)
         rows = []
 
+        get_code = _get_xpath("string(СвОКВЭД/СвОКВЭДОсн/@КодОКВЭД)")
+        xpaths = [(_get_xpath(path), key) for path, key in elements.items()]
+
         for doc in root.iter("Документ"):
             if target_codes is not None:
-                code = doc.xpath("string(СвОКВЭД/СвОКВЭДОсн/@КодОКВЭД)")
+                code = get_code(doc)
                 if code not in target_codes:
                     continue
 
             row = dict.fromkeys(elements.values())
-            for path, key in elements.items():
-                matches = doc.xpath(path)
+            for xpath, key in xpaths:
+                matches = xpath(doc)
                 if len(matches) == 0:
                     continue
                 elif len(matches) == 1:
@@ -65,6 +76,43 @@ def _make_dataframe(item, elements, target_codes=None, debug=True):
     return None
 
 
+# Archives opened in a worker process as (path, archive), keyed by folder.
+# Each dataset has its own folder, and archives of a dataset are processed
+# one by one, so a worker keeps at most one open archive per dataset and
+# closes it as soon as the next one comes. This lets the space of removed
+# local copies of ydisk archives be released
+_worker_archives = {}
+
+
+def _read_from_archive(path, fn):
+    """Read a file from archive opening the archive once per worker process"""
+    folder = str(pathlib.Path(path).parent)
+    opened_path, archive = _worker_archives.get(folder, (None, None))
+    if opened_path != path:
+        if archive is not None:
+            archive.close()
+        archive = zipfile.ZipFile(path)
+        _worker_archives[folder] = (path, archive)
+
+    return archive.read(fn)
+
+
+def _make_dataframe_from_archive(item, elements, target_codes=None, debug=True):
+    if len(item) != 2:
+        print("make_dataframe_from_archive function expects archive path and filename as a [str, str] tuple")
+        return None
+
+    path, fn = item
+    try:
+        xml_string = _read_from_archive(path, fn)
+    except Exception as e:
+        print(f"Cannot read {fn} from {path}, skipping")
+        print(e)
+        return None
+
+    return _make_dataframe((fn, xml_string), elements, target_codes, debug)
+
+
 class Archive:
     def __init__(self, path, start=None, stop=None, step=None):
         self._archive = zipfile.ZipFile(path)
@@ -98,6 +146,10 @@ class Archive:
     def _read(self, fn):
         return self._archive.read(fn)
 
+    def members(self):
+        """Archive path and filename pairs to be read by worker processes"""
+        return [(str(self._path), fn) for fn in self._xml_list]
+
 
 class Extractor:
     STORAGES = [s.value for s in Storages]
@@ -120,13 +172,29 @@ class Extractor:
         self._token = token
         self._storage = storage
         self._temp_dir = None
+        self._pool = None
 
         if storage in (Storages.ydisk.value,):
             self._temp_dir = tempfile.TemporaryDirectory()
 
+    def __enter__(self):
+        """Start worker processes once for all subsequent calls"""
+        self._pool = multiprocessing.Pool(processes=self._num_workers)
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pool.terminate()
+        self._pool = None
+
     def __call__(self, in_dir: str, out_dir: str, source_dataset: str,
                  clear: Optional[bool] = False,
                  activity_codes: Optional[List[str]] = None):
+        if self._pool is None:
+            # Called outside of with statement, so workers live for this call only
+            with self:
+                return self(in_dir, out_dir, source_dataset, clear, activity_codes)
+
         input_files = self._get_files(in_dir)
         if len(input_files) == 0:
             print("Input path does not contain source XML files")
@@ -141,38 +209,45 @@ class Extractor:
 
         print(f"Found {len(input_files)} ZIP archives in data folder")
 
+        debug = True if source_dataset in (SourceDatasets.smb.value,) else False
+        # Workers read and decompress XML files themselves, so that the main
+        # process neither unpacks archives alone nor pipes XML content to them
         func = functools.partial(
-            _make_dataframe,
+            _make_dataframe_from_archive,
             elements=self._get_elements(source_dataset),
             target_codes=self._get_activity_codes(activity_codes, source_dataset),
-            debug=True if source_dataset in (SourceDatasets.smb.value,) else False
+            debug=debug
         )
+        schema = self._get_parquet_schema(source_dataset, debug)
 
         for filename in input_files:
             if filename in history:
                 print(f"{filename} already processed")
                 continue
 
-            path = self._resolve_local_file_path(in_dir, filename)
+            path = self._resolve_local_file_path(in_dir, filename, source_dataset)
             print(f"Processing {filename}")
-            out_file = pathlib.Path(out_dir) / f"{path.stem}.csv"
+            out_file = pathlib.Path(out_dir) / f"{path.stem}.parquet"
 
             st = time.time()
             archive = Archive(path)
 
-            with multiprocessing.Pool(processes=self._num_workers) as pool:
+            with pq.ParquetWriter(out_file, schema) as writer:
                 for df in tqdm(
-                    pool.imap(func, archive, chunksize=self._chunksize),
+                    self._pool.imap(func, archive.members(), chunksize=self._chunksize),
                     total=len(archive)
                 ):
                     if df is None:
                         print("Empty df returned")
                         continue
 
-                    if out_file.exists():
-                        df.to_csv(out_file, index=False, header=False, mode="a")
-                    else:
-                        df.to_csv(out_file, index=False)
+                    # Each XML file becomes a row group of the archive's Parquet file
+                    table = pa.Table.from_pandas(
+                        df.reindex(columns=schema.names),
+                        schema=schema,
+                        preserve_index=False
+                    )
+                    writer.write_table(table)
 
             et = time.time()
             duration = et - st
@@ -183,8 +258,12 @@ class Extractor:
             self._dump_history(history, history_file_path)
             del archive
 
-    def _download(self, data_path: str, filename: str) -> pathlib.Path:
-        print(f"Downloading file from Yandex Disk to {self._temp_dir.name}")
+    def _download(self, data_path: str, filename: str,
+                  source_dataset: str) -> pathlib.Path:
+        # Datasets may be extracted concurrently, so each one gets a subfolder
+        download_dir = pathlib.Path(self._temp_dir.name) / source_dataset
+        download_dir.mkdir(exist_ok=True)
+        print(f"Downloading file from Yandex Disk to {download_dir}")
 
         api_path = "disk/resources/download"
         headers = {
@@ -210,7 +289,7 @@ class Extractor:
             print("Cannot download file")
             return None
 
-        downloaded_file = pathlib.Path(self._temp_dir.name) / filename
+        downloaded_file = download_dir / filename
         with open(downloaded_file, "wb") as f:
             for chunk in tqdm(resp.iter_content(2**20)): # chunk size is 1 Mib
                 f.write(chunk)
@@ -290,11 +369,12 @@ class Extractor:
         else:
             out_path.mkdir(parents=True)
 
-    def _resolve_local_file_path(self, data_path: str, filename: str) -> pathlib.Path:
+    def _resolve_local_file_path(self, data_path: str, filename: str,
+                                 source_dataset: str) -> pathlib.Path:
         if self._storage == Storages.local.value:
             file_path = pathlib.Path(data_path) / filename
         else:
-            file_path = self._download(data_path, filename)
+            file_path = self._download(data_path, filename, source_dataset)
 
         return file_path
 
@@ -309,7 +389,7 @@ class Extractor:
         print(f"Local copy of downloaded file at {path} removed")
 
     def _get_activity_codes(
-            self, codes_from_input: List[str], source_dataset: str) -> Optional[List[str]]:
+            self, codes_from_input: List[str], source_dataset: str) -> Optional[FrozenSet[str]]:
         if source_dataset not in (SourceDatasets.smb.value, ):
             return None
 
@@ -347,10 +427,20 @@ class Extractor:
             print("Activity codes to filter")
             print(codes)
 
-            codes = list(codes["code"])
+            # Prefixes are already expanded to exact codes using the classifier,
+            # so a set gives constant-time check for every document
+            codes = frozenset(codes["code"])
 
         return codes
 
+    def _get_parquet_schema(self, source_dataset: str, debug: bool) -> pa.Schema:
+        # Values are stored as extracted, types are applied on reading by Spark
+        columns = list(self._get_elements(source_dataset).values())
+        if debug:
+            columns += ["file_id", "doc_cnt"]
+
+        return pa.schema([(column, pa.string()) for column in columns])
+
     def _get_elements(self, source_dataset: str):
         if source_dataset not in self.SOURCE_DATASETS:
             raise RuntimeError(f"(Unknown source dataset {source_dataset}, "
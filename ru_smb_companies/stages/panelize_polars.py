@@ -0,0 +1,50 @@
+from typing import Optional
+
+import polars as pl
+
+from ..stages.polars_stage import PolarsStage
+from ..utils.polars_schemas import (smb_geocoded_schema, revexp_agg_schema,
+    empl_agg_schema)
+
+
+class PolarsPanelizer(PolarsStage):
+    """Polars version of Panelizer producing the same panel table"""
+
+    def __call__(self, smb_file: str, out_file: str,
+                 revexp_file: Optional[str] = None,
+                 empl_file: Optional[str] = None):
+        smb_data = self._read(smb_file, smb_geocoded_schema)
+        if smb_data is None:
+            return
+
+        panel = (
+            smb_data
+            .with_columns(
+                pl.int_ranges(
+                    pl.col("start_date").dt.year(),
+                    pl.col("end_date").dt.year() + 1,
+                    dtype=pl.Int16
+                ).alias("year")
+            )
+            .explode("year")
+            .filter(pl.col("year").is_not_null())
+        )
+
+        if revexp_file is not None:
+            revexp_data = self._read(revexp_file, revexp_agg_schema)
+            if revexp_data is not None:
+                panel = panel.join(revexp_data, on=["tin", "year"], how="left")
+
+        if empl_file is not None:
+            empl_data = self._read(empl_file, empl_agg_schema)
+            if empl_data is not None:
+                panel = panel.join(empl_data, on=["tin", "year"], how="left")
+
+        # Join keys go first, as in Spark output
+        panel = (
+            panel
+            .select("tin", "year", pl.exclude("tin", "year"))
+            .sort("tin", "year")
+        )
+
+        self._write(panel, out_file, separator=";")
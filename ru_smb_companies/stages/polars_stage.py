@@ -0,0 +1,56 @@
+import os
+import pathlib
+from typing import Dict, Optional
+
+import polars as pl
+
+
+class PolarsStage:
+    """Single-machine alternative to SparkStage with the same _read/_write API"""
+
+    def _read(self, in_path: str, schema: Dict[str, pl.DataType],
+              **kwargs) -> Optional[pl.LazyFrame]:
+        path = pathlib.Path(in_path)
+        if not path.exists():
+            print(f"Input path {in_path} not found")
+            return None
+
+        if path.is_dir():
+            pattern = "data-*.csv"
+            has_input = next(path.glob(pattern), None) is not None
+            source = str(path / pattern) if has_input else None
+        elif path.suffix in (".csv",):
+            source = str(path)
+        else:
+            source = None
+
+        if source is None:
+            print("Input path does not contain readable CSV file(s)")
+            return None
+
+        options = dict(has_header=True, null_values="NA")
+        options.update(kwargs)
+
+        print(f"Reading source data at {in_path}")
+
+        return pl.scan_csv(source, schema=schema, **options)
+
+    def _write(self, lf: pl.LazyFrame, out_file: str, **kwargs):
+        """Stream lazy frame into a single CSV file"""
+        out_path = pathlib.Path(out_file)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+
+        options = dict(include_header=True, null_value="NA")
+        options.update(kwargs)
+
+        # Data is written next to the destination file and then renamed,
+        # so that a failed run does not leave a truncated result
+        temp_file = out_path.with_name(f".{out_path.name}.tmp")
+
+        try:
+            lf.sink_csv(temp_file, **options)
+            os.replace(temp_file, out_path)
+        finally:
+            temp_file.unlink(missing_ok=True)
+
+        print(f"Saved to {out_file}")
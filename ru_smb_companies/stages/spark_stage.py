@@ -1,37 +1,67 @@
+import atexit
+import os
 import pathlib
 import shutil
 import tempfile
-from typing import Optional
+import threading
+from typing import List, Optional
 
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from pyspark.sql import DataFrame, SparkSession
-from pyspark.sql.types import StructType
+import pyspark.sql.functions as F
+from pyspark.sql.pandas.types import to_arrow_schema
+from pyspark.sql.types import DateType, StructField, StructType
+
+
+# Spark session is shared by all stages to start JVM only once per run;
+# stages may be created concurrently, so its creation is guarded by a lock
+_shared_session: Optional[SparkSession] = None
+_shared_session_lock = threading.Lock()
+
+
+def _stop_shared_session():
+    print("Stopping Spark")
+    _shared_session.stop()
 
 
 class SparkStage:
     SPARK_APP_NAME = "Generic Spark Stage"
+    SPARK_DRIVER_MEMORY = "4g"
+    ARROW_READ_MAX_SIZE = 256 * 2**20 # 256 Mib
 
     def __init__(self):
         self._session = None
 
         self._init_spark()
 
-    def __del__(self):
-        print("Stopping Spark")
-        self._session.stop()
-
     def _init_spark(self):
         """Spark configuration and initialization"""
-        print("Starting Spark")
-        self._session = (
-            SparkSession
-            .builder
-            .master("local")
-            .appName(self.SPARK_APP_NAME)
-            .getOrCreate()
-        )
-
-        web_url = self._session.sparkContext.uiWebUrl
-        print(f"Spark session has started. You can monitor it at {web_url}")
+        global _shared_session
+
+        with _shared_session_lock:
+            if _shared_session is None:
+                print("Starting Spark")
+                num_cores = os.cpu_count() or 1
+                _shared_session = (
+                    SparkSession
+                    .builder
+                    .master(f"local[{num_cores}]")
+                    .appName(self.SPARK_APP_NAME)
+                    .config("spark.driver.memory", self.SPARK_DRIVER_MEMORY)
+                    # Default 200 shuffle partitions is too many for a single machine
+                    .config("spark.sql.shuffle.partitions", num_cores * 2)
+                    .config("spark.sql.adaptive.enabled", "true")
+                    .config("spark.sql.adaptive.coalescePartitions.enabled", "true")
+                    .config("spark.sql.execution.arrow.pyspark.enabled", "true")
+                    .getOrCreate()
+                )
+                atexit.register(_stop_shared_session)
+
+                web_url = _shared_session.sparkContext.uiWebUrl
+                print(f"Spark session has started. You can monitor it at {web_url}")
+
+        self._session = _shared_session
 
     def _read(self, in_path: str, schema: StructType, **kwargs) -> DataFrame:
         path = pathlib.Path(in_path)
@@ -39,47 +69,147 @@ class SparkStage:
             print(f"Input path {in_path} not found")
             return None
 
+        # Extraction used to produce CSV files, so a directory may hold
+        # both older CSV and newer Parquet files; both are read then
+        parquet_data = None
+        if path.is_dir() and next(path.glob("data-*.parquet"), None) is not None:
+            parquet_data = self._read_parquet(
+                str(path / "data-*.parquet"), schema, kwargs.get("dateFormat"))
+
+        # Small files in default format are parsed faster by multithreaded Arrow
+        if (path.is_file() and path.suffix in (".csv",) and len(kwargs) == 0
+                and path.stat().st_size <= self.ARROW_READ_MAX_SIZE):
+            data = self._read_with_arrow(str(path), schema)
+            if data is not None:
+                return data
+
         if path.is_dir():
-            input_files = [str(fn) for fn in path.glob("data-*.csv")]
+            # Spark lists files matching the pattern itself,
+            # so here we only check that at least one of them exists
+            pattern = "data-*.csv"
+            has_input = next(path.glob(pattern), None) is not None
+            input_files = [str(path / pattern)] if has_input else []
         elif path.suffix in (".csv",):
             input_files = [str(path)]
         else:
             input_files = []
 
         if len(input_files) == 0:
+            if parquet_data is not None:
+                return parquet_data
+
             print("Input path does not contain readable CSV file(s)")
             return None
 
+        # Missing values are written as NA by _write, and Arrow reader
+        # treats NA as null as well
         options = {
             "header": True,
             "escape": '"',
+            "nullValue": "NA",
         }
         options.update(kwargs)
 
         print(f"Reading source data at {in_path}")
 
+        # Rows are not counted here: it would need a full pass over data
         data = self._session.read.options(**options).schema(schema).csv(input_files)
 
-        print(f"Source CSV contains {data.count()} rows")
+        if parquet_data is not None:
+            data = data.unionByName(parquet_data)
 
         return data
 
+    def _read_with_arrow(self, in_path: str, schema: StructType) -> Optional[DataFrame]:
+        """Parse CSV file with PyArrow and pass it to Spark as Arrow batches"""
+        print(f"Reading source data at {in_path} with Arrow")
+
+        # Spark CSV reader makes all fields nullable, so the same is done here
+        schema = StructType([
+            StructField(field.name, field.dataType, True) for field in schema.fields
+        ])
+
+        # Columns are matched by position, as Spark does with a given schema
+        read_options = pa_csv.ReadOptions(column_names=schema.names, skip_rows=1)
+        convert_options = pa_csv.ConvertOptions(
+            column_types=to_arrow_schema(schema),
+            null_values=["", "NA"],
+            strings_can_be_null=True
+        )
+        try:
+            table = pa_csv.read_csv(
+                in_path, read_options=read_options, convert_options=convert_options)
+        except pa.ArrowInvalid as e:
+            # Unlike Spark, Arrow fails on malformed values instead of nulling them
+            print("Cannot read data with Arrow, falling back to Spark CSV reader")
+            print(e)
+            return None
+
+        return self._session.createDataFrame(
+            table.to_pandas(self_destruct=True), schema=schema)
+
+    def _read_parquet(self, in_path: str, schema: StructType,
+                      date_format: Optional[str] = None) -> DataFrame:
+        """Read extracted Parquet files with string columns casting them to schema"""
+        print(f"Reading source data at {in_path}")
+
+        data = self._session.read.parquet(in_path)
+
+        columns = []
+        for field in schema.fields:
+            if field.name not in data.columns:
+                column = F.lit(None)
+            elif isinstance(field.dataType, DateType) and date_format is not None:
+                column = F.to_date(field.name, date_format)
+            else:
+                column = F.col(field.name)
+            columns.append(column.cast(field.dataType).alias(field.name))
+
+        return data.select(*columns)
+
     def _write(self, df: DataFrame, out_file: str, **kwargs):
         """Save Spark dataframe into a single CSV file"""
-        with tempfile.TemporaryDirectory() as out_dir:
+        # Temporary directory is created next to the destination file,
+        # so that the result is moved with a cheap rename instead of a copy
+        out_path = pathlib.Path(out_file)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_dir = pathlib.Path(
+            tempfile.mkdtemp(prefix=".spark_tmp_", dir=out_path.parent))
+
+        try:
             options = dict(header=True, nullValue="NA", escape='"')
             options.update(**kwargs)
 
             print("Writing to temporary directory")
-            df.coalesce(1).write.options(**options).csv(out_dir, mode="overwrite")
+            df.write.options(**options).csv(str(out_dir / "parts"), mode="overwrite")
 
-            # Spark writes to a folder with an arbitrary filename,
-            # so we need to find and move the resulting file to the destination
-            result = next(pathlib.Path(out_dir).glob("*.csv"), None)
-            if result is None:
+            # Spark writes a part file per partition in parallel,
+            # so we need to concatenate them into the destination file
+            parts = sorted((out_dir / "parts").glob("part-*.csv"))
+            if len(parts) == 0:
                 print("Failed to save file")
+                return
+
+            if len(parts) == 1:
+                result = parts[0]
+            else:
+                result = out_dir / "result.csv"
+                self._concat_parts(parts, result)
 
-            pathlib.Path(out_file).parent.mkdir(parents=True, exist_ok=True)
-            shutil.move(result, out_file)
+            os.replace(result, out_path)
 
             print(f"Saved to {out_file}")
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    def _concat_parts(self, parts: List[pathlib.Path], out_file: pathlib.Path):
+        """Concatenate CSV part files keeping only the first header"""
+        with open(out_file, "wb") as dst:
+            header_written = False
+            for part in parts:
+                with open(part, "rb") as src:
+                    header = src.readline()
+                    if not header_written:
+                        dst.write(header)
+                        header_written = True
+                    shutil.copyfileobj(src, dst, length=2**20)
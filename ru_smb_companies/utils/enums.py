@@ -1,6 +1,11 @@
 import enum
 
 
+class Engines(enum.Enum):
+    spark = "spark"
+    polars = "polars"
+
+
 class SourceDatasets(enum.Enum):
     smb = "smb"
     revexp = "revexp"
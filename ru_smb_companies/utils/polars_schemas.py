@@ -0,0 +1,39 @@
+import polars as pl
+
+
+smb_geocoded_schema = {
+    "tin": pl.Utf8,
+    "reg_number": pl.Utf8,
+    "kind": pl.Int8,
+    "category": pl.Int8,
+    "first_name": pl.Utf8,
+    "last_name": pl.Utf8,
+    "patronymic": pl.Utf8,
+    "org_name": pl.Utf8,
+    "org_short_name": pl.Utf8,
+    "activity_code_main": pl.Utf8,
+    "region_iso_code": pl.Utf8,
+    "region_code": pl.Utf8,
+    "region": pl.Utf8,
+    "area": pl.Utf8,
+    "settlement": pl.Utf8,
+    "settlement_type": pl.Utf8,
+    "oktmo": pl.Utf8,
+    "lat": pl.Float32,
+    "lon": pl.Float32,
+    "start_date": pl.Date,
+    "end_date": pl.Date,
+}
+
+revexp_agg_schema = {
+    "tin": pl.Utf8,
+    "year": pl.Int16,
+    "revenue": pl.Float32,
+    "expenditure": pl.Float32,
+}
+
+empl_agg_schema = {
+    "tin": pl.Utf8,
+    "year": pl.Int16,
+    "employees_count": pl.Int32,
+}
@@ -0,0 +1,111 @@
+import functools
+import inspect
+import json
+import os
+import pathlib
+from typing import Any, Callable, Dict, List, Optional
+
+
+def _describe_output(path: pathlib.Path) -> Optional[List[int]]:
+    if not path.is_file():
+        return None
+
+    stat = path.stat()
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _load_manifest(path: pathlib.Path) -> Optional[dict]:
+    """Previous state of a stage, None if it is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _dump_manifest(state: dict, path: pathlib.Path):
+    # Manifest is replaced at once, so an interrupted run cannot truncate it
+    temp_path = path.with_name(f".{path.name}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+
+def _describe_inputs(paths: List[str]) -> Dict[str, List[int]]:
+    """Size and modification time of every input file, directories are walked"""
+    result = {}
+    for path in paths:
+        path = pathlib.Path(path)
+        if path.is_dir():
+            files = sorted(f for f in path.rglob("*") if f.is_file())
+        elif path.is_file():
+            files = [path]
+        else:
+            files = []
+
+        for f in files:
+            stat = f.stat()
+            result[str(f)] = [stat.st_size, stat.st_mtime_ns]
+
+    return result
+
+
+def stage_cache(inputs: List[str], output: str,
+                settings: Optional[Callable[[], Dict[str, Any]]] = None):
+    """
+    Skip a stage if its output exists and its inputs have not changed
+    since the previous run
+
+    *inputs* and *output* are names of arguments of the decorated function
+    holding respective paths. *settings* optionally returns other values
+    the output depends on, e.g. config options; the stage runs again if they
+    change. The state of inputs, settings and output is saved next to
+    the output file in *<output>.manifest.json*; remove it to force the stage
+    to run.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+
+            input_paths = [
+                str(bound.arguments[name]) for name in inputs
+                if bound.arguments[name] is not None
+            ]
+            output_path = pathlib.Path(bound.arguments[output])
+            manifest_path = output_path.with_name(output_path.name + ".manifest.json")
+
+            inputs_state = _describe_inputs(input_paths)
+            settings_state = settings() if settings is not None else {}
+            output_state = _describe_output(output_path)
+            state = {
+                "inputs": inputs_state,
+                "settings": settings_state,
+                "output": output_state,
+            }
+            if output_state is not None:
+                previous_state = _load_manifest(manifest_path)
+                if previous_state == state:
+                    print(f"Inputs of {func.__name__} have not changed since "
+                          f"{output_path} was made, skipping. "
+                          f"Remove {manifest_path} to run it anyway")
+                    return None
+
+            result = func(*args, **kwargs)
+
+            # Stages may fail without raising, leaving an older output in place,
+            # so the manifest is only written if the output has been replaced
+            new_output_state = _describe_output(output_path)
+            if new_output_state is not None and new_output_state != output_state:
+                state["output"] = new_output_state
+                _dump_manifest(state, manifest_path)
+
+            return result
+
+        return wrapper
+
+    return decorator